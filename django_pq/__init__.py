@@ -1,8 +1,15 @@
 # coding: utf-8
 
 from .lazy import reveal, LazyContext
-from .cache import LazySubstitute
+from .cache import LazySubstitute, AdaptivePolicy
+from .fragments import PreparedFragment
+from .tracing import QueryTracer
+from .registry import TemplateRegistry, registry
+from .writes import (LazyWriteSubstitute, PreparedBulkInsert, update_query,
+                     delete_query)
 
 
-# nice decorator name
+# nice decorator names
 substitute_lazy = LazySubstitute
+substitute_lazy_write = LazyWriteSubstitute
+prepared_fragment = PreparedFragment
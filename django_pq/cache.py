@@ -1,14 +1,18 @@
 # coding: utf-8
+import hashlib
 import logging
 from collections import defaultdict
 from functools import wraps
 from logging import getLogger
+from timeit import default_timer
 
 from django.db import models
 from typing import Dict, Tuple, Any, Callable, Optional
 
 from .lazy import LazyContext, Lazy
-from .queryset import normalize, RawQuerySet
+from .queryset import normalize, RawQuerySet, QueryTemplate
+from .registry import TemplateRegistry, registry as default_registry
+from .tracing import QueryTracer, TracedRawQuerySet, tag_sql
 
 
 # Type definitions
@@ -21,7 +25,7 @@ ParamsType = Tuple[Any]
 SqlWithParams = Tuple[str, ParamsType]
 
 # prepared queries cache for arguments values
-QueryCache = Dict[Tuple, RawQuerySet]
+QueryCache = Dict[Tuple, QueryTemplate]
 
 # prepared queries cache for arguments list
 CacheType = Dict[Tuple, QueryCache]
@@ -51,26 +55,143 @@ class Stub(object):
         return '/stub/'
 
 
-class LazySubstitute(object):
-    """ Decorator for queryset caching."""
+class CallStats(object):
+    """ Decorated function calls statistics for a signature."""
+
+    def __init__(self):
+        self.calls = 0
+        # total decorated function call time
+        self.elapsed = 0.0
+
+
+class AdaptivePolicy(object):
+    """ Per-function and signature caching switch based on measured savings.
+
+    Average lazy queryset construction and compilation time on cache misses
+    is used as native call cost estimate; it is kept between measurement
+    windows, so re-probing with warm cache is compared against it too. If
+    cached calls are slower than native ones in average, caching is bypassed
+    for a function and signature and re-probed later.
+    """
 
     logger = getLogger('django.db.backends.Substitute')
 
+    def __init__(self, window=100, bypass=1000):
+        """
+        :param window: calls count for measuring caching efficiency
+        :param bypass: native calls count before caching is re-probed
+        """
+        self.window = window
+        self.bypass = bypass
+        self.stats = defaultdict(CallStats)  # type: Dict[Tuple, CallStats]
+        # cache misses count and total compilation time for functions and
+        # signatures
+        self.compile_costs = {}  # type: Dict[Tuple, Tuple[int, float]]
+        # remaining native calls count for bypassed functions and signatures
+        self.bypassed = {}  # type: Dict[Tuple, int]
+
+    def is_enabled(self, func, signature):
+        # type: (Callable, Tuple) -> bool
+        """ Checks whether caching is enabled for current call."""
+        key = (func, signature)
+        left = self.bypassed.get(key)
+        if left is None:
+            return True
+        if left > 1:
+            self.bypassed[key] = left - 1
+        else:
+            # re-probing caching after this call
+            del self.bypassed[key]
+        return False
+
+    def record(self, func, signature, elapsed, compile_time=None):
+        # type: (Callable, Tuple, float, Optional[float]) -> None
+        """ Records cached call time.
+
+        :param func: decorated function
+        :param signature: decorated function arguments names
+        :param elapsed: decorated function call time excluding debug checks
+        :param compile_time: lazy queryset compilation time for cache misses
+        """
+        key = (func, signature)
+        stats = self.stats[key]
+        stats.calls += 1
+        stats.elapsed += elapsed
+        if compile_time is not None:
+            misses, total = self.compile_costs.get(key, (0, 0.0))
+            self.compile_costs[key] = (misses + 1, total + compile_time)
+        if stats.calls < self.window:
+            return
+        del self.stats[key]
+        if key not in self.compile_costs:
+            return
+        misses, total = self.compile_costs[key]
+        native_time = stats.calls * total / misses
+        if stats.elapsed > native_time:
+            self.logger.debug("Caching bypassed for %s%s: %.6f > %.6f" %
+                              (func.__name__, signature, stats.elapsed,
+                               native_time))
+            self.bypassed[key] = self.bypass
+
+
+class CacheKeyMixin(object):
+    """ Cache key computation for function arguments."""
+
     special = [True, False, None, 0, 1]
 
     stub = Stub()
 
-    def __init__(self, check=True, debug=True, enabled=True):
+    def get_cache_key(self, params):
+        """
+        Computes cache key respecting presence, type and some values of
+        function arguments.
+        """
+        result = []
+        for p in params:
+            if p in self.special:
+                # known constants are used directly in cache key
+                result.append(p)
+            else:
+                # unknown values are marked as "parameter is present"
+                result.append(self.stub)
+        return tuple(result)
+
+
+class LazySubstitute(CacheKeyMixin):
+    """ Decorator for queryset caching."""
+
+    logger = getLogger('django.db.backends.Substitute')
+
+    def __init__(self, check=True, debug=True, enabled=True, fragments=(),
+                 policy=None, tag=False, tracer=None, registry=None):
         """
         :param check: enables checking real and lazy results before caching
         :param debug: enables debug mode
         :param enabled: flag for complete disable of caching
+        :param fragments: names of arguments passed only to prepared
+            fragments; their values are not used in cache key.
+        :param policy: AdaptivePolicy instance for per-signature disabling
+            of caching
+        :param tag: enables adding template ID comment to cached SQL
+        :param tracer: QueryTracer instance for reporting substitute and
+            materialize times; enables tag
+        :param registry: TemplateRegistry instance for storing prepared
+            queries, process-wide one by default
         """
-        # prepared queries cache
-        self.cache = defaultdict(dict)  # type: CacheType
+        # prepared queries caches for decorated function and model
+        self.cache = {}  # type: Dict[Tuple, CacheType]
+        self.registry = (registry or
+                         default_registry)  # type: TemplateRegistry
+        self.registry.register(self)
         self.DEBUG = debug
         self.check = check or debug
         self.enabled = enabled
+        self.fragments = frozenset(fragments)
+        self.policy = policy  # type: Optional[AdaptivePolicy]
+        self.tracer = tracer  # type: Optional[QueryTracer]
+        self.tag = tag or tracer is not None
+        # template IDs for functions, signatures and cache keys
+        self.template_ids = {}  # type: Dict[Tuple, str]
         if not debug:
             self.logger.setLevel(logging.ERROR)
 
@@ -80,48 +201,55 @@ class LazySubstitute(object):
         if not self.enabled:
             return func
 
-        self.func = func
-        self._func_repr = repr(func)
-
         @wraps(func)
         def inner(this, **kwargs):
             try:
-                return self.do_call(this, **kwargs)
+                return self.do_call(func, this, **kwargs)
             finally:
                 LazyContext.allow_values()
 
         return inner
 
-    def get_cache_key(self, params):
+    def get_cache(self, func, this):
+        # type: (WrappingFuncType, Any) -> CacheType
         """
-        Computes cache key respecting presence, type and some values of
-        function arguments.
+        Returns prepared queries cache for decorated function, model and
+        database.
         """
-        result = []
-        for p in params:
-            if p in self.special:
-                # known constants are used directly in cache key
-                result.append(p)
-            else:
-                # unknown values are marked as "parameter is present"
-                result.append(self.stub)
-        return tuple(result)
+        model = getattr(this, 'model', None)
+        using = self.get_db(this)
+        try:
+            return self.cache[func, model, using]
+        except KeyError:
+            # decorators with same options share prepared queries
+            key = (func, model, using, self.__class__, self.fragments,
+                   self.tag)
+            cache = self.cache[func, model, using] = self.registry.get_cache(
+                key)
+            return cache
 
-    def get_native_queryset(self, this, **kwargs):
-        # type: (Any, Dict[str, Any]) -> QS
+    @staticmethod
+    def get_db(this):
+        # type: (Any) -> Optional[str]
+        """ Returns database alias for "self" of wrapped method."""
+        return getattr(this, 'db', None)
+
+    @staticmethod
+    def get_native_queryset(func, this, **kwargs):
+        # type: (WrappingFuncType, Any, Dict[str, Any]) -> QS
         """
         Computes native queryset without any caching
         """
-        qs = self.func(this, **kwargs)
+        qs = func(this, **kwargs)
         return qs
 
-    def get_lazy_result(self, this, **kwargs):
-        # type: (Any, Dict[str, Any]) -> QS
+    def get_lazy_result(self, func, this, **kwargs):
+        # type: (WrappingFuncType, Any, Dict[str, Any]) -> QS
         """
         Computes queryset with Lazy parameters passed to function
         """
         kwargs = {k: Lazy(k, v) for k, v in kwargs.items()}
-        return self.get_native_queryset(this, **kwargs)
+        return self.get_native_queryset(func, this, **kwargs)
 
     def assert_equivalent(self, first, second, message):
         # type: (SqlWithParams, SqlWithParams) -> None
@@ -139,64 +267,143 @@ class LazySubstitute(object):
                     (sql1, repr(params1), repr(params2)))))
             raise ParamsMappingFailed(sql1, params1, params2)
 
-    def cache_result(self, cache, cache_key, lazy_qs, real_qs=None):
-        # type: (QueryCache, tuple, QS, Optional[QS]) -> RawQuerySet
+    def get_template_id(self, func, model, signature, cache_key):
+        # type: (WrappingFuncType, Optional[type], Tuple, Tuple) -> str
+        """ Returns stable ID of cached SQL template."""
+        try:
+            return self.template_ids[func, model, signature, cache_key]
+        except KeyError:
+            func_name = getattr(func, '__qualname__', func.__name__)
+            if model is not None:
+                # same method of a manager shared by different models
+                opts = model._meta
+                label = '%s.%s' % (opts.app_label, opts.object_name)
+            else:
+                label = None
+            key_hash = hashlib.md5(repr((label, signature, cache_key)).encode(
+                'utf-8')).hexdigest()
+            template_id = 'pq:%s:%s' % (func_name, key_hash[:8])
+            self.template_ids[func, model, signature, cache_key] = template_id
+            return template_id
+
+    def cache_result(self, cache, cache_key, lazy_qs, real_qs=None,
+                     template_id=None, lazy=None):
+        # type: (QueryCache, tuple, QS, Optional[QS], Optional[str], Any) -> Any
         """ Caches queryset if it is possible.
 
         :param cache: cache for current argument list
         :param cache_key: cache key for current call
         :param lazy_qs: function call result with Lazy-parameters
         :param real_qs: native function call result
+        :param template_id: template ID for SQL comment
+        :param lazy: compiled lazy_qs if it is already computed
         """
 
-        lazy = lazy_qs.query.sql_with_params()
+        if lazy is None:
+            lazy = self.get_sql_with_params(lazy_qs)
 
         if real_qs is not None:
-            real = real_qs.query.sql_with_params()
+            real = self.get_sql_with_params(real_qs)
             self.assert_equivalent(lazy, real, "Can't cache queryset")
 
         sql, params = lazy
+        if template_id is not None:
+            sql = tag_sql(sql, template_id)
+        sql = self.registry.intern_sql(sql)
+        slots = self.registry.get_slots(params)
 
-        raw_qs = RawQuerySet(sql, params=params, model=lazy_qs.model)
+        raw_qs = self.get_prepared_result(sql, slots, lazy_qs)
+        raw_qs.plain_query = self.registry.intern_sql(raw_qs.plain_query)
 
         cache[cache_key] = raw_qs
         return raw_qs
 
     @staticmethod
-    def get_normalized_queryset(qs):
-        # type: (RawQuerySet) -> RawQuerySet
+    def get_sql_with_params(qs):
+        # type: (QS) -> SqlWithParams
+        """ Compiles function call result to SQL."""
+        return qs.query.get_compiler(qs.db).as_sql()
+
+    @staticmethod
+    def get_prepared_result(sql, slots, qs):
+        # type: (str, Tuple, QS) -> QueryTemplate
+        """ Constructs cached object for compiled function call result."""
+        return QueryTemplate(sql, slots, model=qs.model, using=qs.db)
+
+    @staticmethod
+    def get_normalized_queryset(qs, values):
+        # type: (QueryTemplate, Dict[str, Any]) -> RawQuerySet
         """
-        Returns a copy of cached queryset with SQL query normalized respecting
-        current actual parameters values.
+        Returns a queryset for cached template with SQL query normalized
+        respecting current actual parameters values.
         """
-        sql, params = normalize(qs.raw_query, qs.params)
+        sql, params = qs.render(values)
 
-        return RawQuerySet(sql, model=qs.model, params=params)
+        return RawQuerySet(sql, model=qs.model, params=params, using=qs.using)
 
-    def do_call(self, this, **kwargs):
+    @staticmethod
+    def get_traced_result(qs, tracer, template_id):
+        # type: (RawQuerySet, QueryTracer, str) -> RawQuerySet
+        """ Returns a copy of queryset reporting materialization time."""
+        traced_qs = TracedRawQuerySet(qs.raw_query, model=qs.model,
+                                      params=qs.params, using=qs._db)
+        traced_qs.tracer = tracer
+        traced_qs.template_id = template_id
+        return traced_qs
+
+    def get_result(self, func, model, signature, cache_key, cached_qs,
+                   values):
+        # type: (Callable, Any, Tuple, Tuple, QueryTemplate, Dict) -> Any
+        """ Substitutes actual parameter values into cached template."""
+        if self.tracer is None:
+            return self.get_normalized_queryset(cached_qs, values)
+        started = default_timer()
+        normalized_qs = self.get_normalized_queryset(cached_qs, values)
+        template_id = self.get_template_id(func, model, signature, cache_key)
+        self.tracer.report(template_id, 'substitute',
+                           default_timer() - started)
+        return self.get_traced_result(normalized_qs, self.tracer, template_id)
+
+    def do_call(self, func, this, **kwargs):
         """ Handles cache hits and misses
+        :param func: decorated function
         :param this: "self" for wrapped method.
         """
+        started = default_timer()
         signature = tuple(sorted(kwargs))
-        cache_key = self.get_cache_key(kwargs[k] for k in signature)
+        policy = self.policy
+        if policy is not None and not policy.is_enabled(func, signature):
+            return self.get_native_queryset(func, this, **kwargs)
+        # fragment arguments values are cached by prepared fragments
+        cache_key = self.get_cache_key(
+            self.stub if k in self.fragments else kwargs[k] for k in signature)
+        model = getattr(this, 'model', None)
         # argument list cache
-        cache = self.cache[signature]
+        cache = self.get_cache(func, this)[signature]
 
+        # debug checks time is not a part of cached call cost
+        check_time = 0.0
         if self.DEBUG:
+            check_started = default_timer()
             # computing native queryset without any manupulations
-            expected_qs = self.get_native_queryset(this, **kwargs)
-            expected = expected_qs.query.sql_with_params()
+            expected_qs = self.get_native_queryset(func, this, **kwargs)
+            expected = self.get_sql_with_params(expected_qs)
+            if self.tag:
+                template_id = self.get_template_id(func, model, signature,
+                                                   cache_key)
+                expected = (tag_sql(expected[0], template_id), expected[1])
+            check_time = default_timer() - check_started
         else:
             expected = expected_qs = None
         try:
 
             # checking if cached queryset if present for current values
             cached_qs = cache[cache_key]
-            self.logger.debug("Cache hit for %s:%s\n%s" %
-                              (self._func_repr, signature, cache_key))
+            self.logger.debug("Cache hit for %r:%s\n%s",
+                              func, signature, cache_key)
         except KeyError:
-            self.logger.debug("Cache miss for %s:%s\n%s" %
-                              (self._func_repr, signature, cache_key))
+            self.logger.debug("Cache miss for %r:%s\n%s",
+                              func, signature, cache_key)
             # computing native queryset if check before cache flag is active.
             if self.check:
                 # check is forced in __init__ by debug value so real_sq is
@@ -206,29 +413,52 @@ class LazySubstitute(object):
                 # check before cache is disabled
                 real_qs = None
 
-            lazy = self.get_lazy_result(this, **kwargs)
+            if self.tag:
+                template_id = self.get_template_id(func, model, signature,
+                                                   cache_key)
+            else:
+                template_id = None
+
+            # lazy function call and compilation do the same work as native
+            # call, so its time is an estimate of native call cost.
+            compile_started = default_timer()
+            lazy_qs = self.get_lazy_result(func, this, **kwargs)
+            lazy = self.get_sql_with_params(lazy_qs)
+            compile_time = default_timer() - compile_started
 
             try:
                 # caching queryset
-                raw_qs = self.cache_result(cache, cache_key, lazy, real_qs)
+                raw_qs = self.cache_result(cache, cache_key, lazy_qs, real_qs,
+                                           template_id, lazy)
                 # returning RawQuerySet
-                return self.get_normalized_queryset(raw_qs)
+                normalized_qs = self.get_result(func, model, signature,
+                                                cache_key, raw_qs, kwargs)
             except MappingFailed:  # pragma: no cover
                 if self.DEBUG:
                     raise
                 # check before cache failed, returning native queryset.
                 return real_qs
+            if policy is not None:
+                policy.record(func, signature,
+                              default_timer() - started - check_time,
+                              compile_time)
+            return normalized_qs
 
         # cache hit, substituting actual parameter values.
 
-        normalized_qs = self.get_normalized_queryset(cached_qs)
+        normalized_qs = self.get_result(func, model, signature, cache_key,
+                                        cached_qs, kwargs)
 
         if self.DEBUG:
             # check if cached version with actual parameters and native result
             # are equal
-
+            check_started = default_timer()
             cached = (normalized_qs.raw_query, normalized_qs.params)
             self.assert_equivalent(cached, expected,
                                    'Cached result does not match real')
-            self.logger.debug("Used cached result for %s" % self._func_repr)
+            self.logger.debug("Used cached result for %r", func)
+            check_time += default_timer() - check_started
+        if policy is not None:
+            policy.record(func, signature,
+                          default_timer() - started - check_time)
         return normalized_qs
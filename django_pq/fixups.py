@@ -8,7 +8,8 @@ class RawQuerySet(DjangoRawQuerySet):
     # fixed virtual field bug in Django-1.8 for RawQuerySet
 
     def _clone(self):
-        return RawQuerySet(self.raw_query, model=self.model, params=self.params)
+        return RawQuerySet(self.raw_query, model=self.model, params=self.params,
+                           using=self._db)
 
     # noinspection PyProtectedMember
     def __iter__(self):
@@ -0,0 +1,141 @@
+# coding: utf-8
+from django.db import connections, models
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.sql.where import AND
+from typing import Dict, Tuple, Any, Callable
+
+from .cache import CacheKeyMixin
+from .lazy import Lazy, LazyContext, LazyFragment
+from .queryset import QueryTemplate, get_slots
+
+
+# (sql, params)
+SqlWithParams = Tuple[str, Tuple[Any]]
+
+# prepared fragments cache
+FragmentCacheType = Dict[Tuple, QueryTemplate]
+
+# decorated functions type
+FragmentFuncType = Callable[..., models.Q]
+
+# SQL for fragments matching everything or nothing
+FULL_MATCH = '1 = 1'
+EMPTY_MATCH = '1 = 0'
+
+
+class FragmentNode(object):
+    """ WhereNode leaf rendering prepared fragment."""
+
+    # The contents are a black box - assume no aggregates are used.
+    contains_aggregate = False
+    contains_over_clause = False
+
+    def __init__(self, fragment, model, kwargs, alias):
+        self.fragment = fragment
+        self.model = model
+        self.kwargs = kwargs
+        # model table alias in query
+        self.alias = alias
+        # Lazy arguments mean that fragment is compiled within
+        # LazySubstitute-decorated function and must remain a slot in cached
+        # SQL.
+        self.lazy = any(isinstance(v, Lazy) for v in kwargs.values())
+
+    def clone(self):
+        return self.__class__(self.fragment, self.model, self.kwargs,
+                              self.alias)
+
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+
+    def relabeled_clone(self, change_map):
+        clone = self.clone()
+        clone.relabel_aliases(change_map)
+        return clone
+
+    def as_sql(self, compiler, connection):
+        # alias as it is rendered in outer query
+        alias_sql = compiler.quote_name_unless_alias(self.alias)
+        if self.lazy:
+            # fragment SQL is substituted when query template is rendered
+            return '%s', [LazyFragment(self.fragment, self.model,
+                                       connection.alias, self.alias,
+                                       alias_sql, self.kwargs)]
+        return self.fragment.compile(self.model, connection.alias, self.alias,
+                                     alias_sql, self.kwargs)
+
+
+class PreparedFragment(CacheKeyMixin):
+    """ Decorator for independent caching of Q-subtree SQL.
+
+    Decorated function must return Q object for given keyword arguments.
+    Fragment SQL is cached separately from queryset containing it, so
+    branching on fragment arguments does not multiply SQL templates for
+    LazySubstitute-decorated function.
+    """
+
+    def __init__(self, func):
+        # type: (FragmentFuncType) -> None
+        self.func = func
+        # prepared fragments cache
+        self.cache = {}  # type: FragmentCacheType
+
+    def __repr__(self):
+        return '<%s>(%r)' % (self.__class__.__name__, self.func)
+
+    def filter(self, qs, **kwargs):
+        # type: (models.QuerySet, Dict[str, Any]) -> models.QuerySet
+        """ Returns a copy of queryset filtered by fragment."""
+        clone = qs.all()
+        alias = clone.query.get_initial_alias()
+        clone.query.where.add(FragmentNode(self, qs.model, kwargs, alias), AND)
+        return clone
+
+    def compile(self, model, using, alias, alias_sql, kwargs):
+        # type: (type, str, str, str, Dict[str, Any]) -> SqlWithParams
+        """ Computes fragment SQL without any caching.
+
+        Fragments without joins are rendered as plain WHERE conditions,
+        others are rendered as primary key lookup in a subquery.
+
+        :param alias: model table alias in outer query
+        :param alias_sql: model table alias as rendered in outer query
+        """
+        qs = models.QuerySet(model).using(using).filter(self.func(**kwargs))
+        query = qs.query
+        compiler = query.get_compiler(using)
+        try:
+            if len([a for a, c in query.alias_refcount.items() if c]) > 1:
+                sub = qs.order_by().values_list('pk')
+                sql, params = sub.query.get_compiler(using).as_sql()
+                qn = connections[using].ops.quote_name
+                sql = '%s.%s IN (%s)' % (alias_sql, qn(model._meta.pk.column),
+                                         sql)
+            else:
+                # rendering conditions against outer query table alias
+                where = query.where.relabeled_clone(
+                    {query.get_initial_alias(): alias})
+                compiler.quote_cache[alias] = alias_sql
+                sql, params = compiler.compile(where)
+        except EmptyResultSet:
+            return EMPTY_MATCH, ()
+        if not sql:
+            return FULL_MATCH, ()
+        return '(%s)' % sql, tuple(params)
+
+    def resolve(self, model, using, alias, alias_sql, values):
+        # type: (type, str, str, str, Dict[str, Any]) -> SqlWithParams
+        """ Returns fragment SQL normalized for actual argument values."""
+        signature = tuple(sorted(values))
+        cache_key = (using, model, alias_sql, signature,
+                     self.get_cache_key(values[k] for k in signature))
+        try:
+            template = self.cache[cache_key]
+        except KeyError:
+            lazy_kwargs = {k: Lazy(k, v) for k, v in values.items()}
+            with LazyContext(**values):
+                sql, params = self.compile(model, using, alias, alias_sql,
+                                           lazy_kwargs)
+            template = QueryTemplate(sql, get_slots(params))
+            self.cache[cache_key] = template
+        return template.render(values)
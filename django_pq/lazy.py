@@ -1,8 +1,8 @@
 # coding: utf-8
 from datetime import datetime
+from operator import itemgetter
 
 import six
-from django.conf import settings
 from django.db import models
 from django.utils.functional import Promise
 
@@ -48,6 +48,12 @@ class Lazy(Promise):
         except RuntimeError:
             return self
 
+    def get_extractor(self):
+        """
+        Returns callable getting parameter value from actual arguments dict.
+        """
+        return itemgetter(self.__key)
+
     def __str__(self):
         value = self.reveal()
         # datetime values workaround for sqlite3 backend
@@ -130,12 +136,50 @@ def reveal(value):
     return value
 
 
-def reveal_unsafe(value):
-    """ sqlite3 adapter for Lazy classes."""
-    if isinstance(value, Lazy):
-        # noinspection PyProtectedMember
-        return value.reveal(safe=False)
-    return value
+class LazyFragment(object):
+    """ Query parameter slot for prepared fragment SQL."""
+
+    def __init__(self, fragment, model, using, alias, alias_sql, kwargs):
+        self.fragment = fragment
+        self.model = model
+        self.using = using
+        self.alias = alias
+        self.alias_sql = alias_sql
+        self.kwargs = kwargs
+
+    def sql_with_params(self):
+        """
+        Returns fragment SQL with parameters for actual argument values.
+        """
+        values = {k: reveal(v) for k, v in self.kwargs.items()}
+        return self.fragment.resolve(self.model, self.using, self.alias,
+                                     self.alias_sql, values)
+
+    def get_extractor(self):
+        """
+        Returns callable getting fragment SQL with parameters from actual
+        arguments dict.
+        """
+        fragment, model, using = self.fragment, self.model, self.using
+        alias, alias_sql = self.alias, self.alias_sql
+        extractors = {}
+        constants = {}
+        for k, v in self.kwargs.items():
+            if isinstance(v, Lazy):
+                extractors[k] = v.get_extractor()
+            else:
+                constants[k] = v
+
+        def extract(values):
+            kwargs = constants.copy()
+            for name, get_value in extractors.items():
+                kwargs[name] = get_value(values)
+            return fragment.resolve(model, using, alias, alias_sql, kwargs)
+
+        return extract
+
+    def __repr__(self):
+        return '<%s>(%r)' % (self.__class__.__name__, self.fragment)
 
 
 class LazyContext(object):
@@ -172,11 +216,3 @@ class LazyContext(object):
         """ Allows returning actual values for current context."""
         if cls.instance:
             cls.instance.values_allowed = True
-
-
-if 'sqlite3' in settings.DATABASES['default']['ENGINE']:
-    # sqlite3 adapters for Lazy-classes.
-    # MySQL uses Lazy.__str__ for that purposes.
-    import sqlite3
-    for lazy_klass in (Lazy, IntLazy, UnicodeLazy):
-        sqlite3.register_adapter(lazy_klass, reveal_unsafe)
@@ -3,10 +3,14 @@ from datetime import datetime
 
 import django
 
-from django_pq.lazy import reveal
+from django_pq.lazy import reveal, Lazy, LazyFragment
 
 
-__all__ = ['normalize', 'RawQuerySet']
+__all__ = ['normalize', 'RawQuerySet', 'QueryTemplate', 'get_slots']
+
+
+# query parameter slot kinds
+CONSTANT, VALUE, FRAGMENT = range(3)
 
 
 if django.VERSION < (1, 9, 0):
@@ -22,14 +26,20 @@ def datetime_to_str(p):
 
 
 def normalize(sql, params=None):
-    """ Reveals actual parameter values and flattens params for IN lookups."""
+    """ Reveals actual parameter values, flattens params for IN lookups and
+    substitutes prepared fragments SQL."""
     if params is None:
         sql, params = sql
 
     placeholders = []
     real_params = []
     for p in map(reveal, params):
-        if isinstance(p, (list, tuple)):
+        if isinstance(p, LazyFragment):
+            # %s -> (fragment sql)
+            fragment_sql, fragment_params = p.sql_with_params()
+            placeholders.append(fragment_sql)
+            real_params.extend(fragment_params)
+        elif isinstance(p, (list, tuple)):
             # IN(%s) -> IN(%s,%s,%s)
             placeholders.append(', '.join(['%s'] * len(p)))
             real_params.extend(p)
@@ -37,3 +47,63 @@ def normalize(sql, params=None):
             placeholders.append('%s')
             real_params.append(p)
     return sql % tuple(placeholders), tuple(map(datetime_to_str, real_params))
+
+
+def get_slots(params):
+    """ Converts query parameters to (kind, value or extractor) pairs."""
+    slots = []
+    for p in params:
+        if isinstance(p, LazyFragment):
+            slots.append((FRAGMENT, p.get_extractor()))
+        elif isinstance(p, Lazy):
+            slots.append((VALUE, p.get_extractor()))
+        else:
+            slots.append((CONSTANT, p))
+    return tuple(slots)
+
+
+class QueryTemplate(object):
+    """ Cached SQL with extractors of parameters from actual arguments."""
+
+    def __init__(self, raw_query, slots, model=None, using=None):
+        self.raw_query = raw_query
+        self.slots = slots
+        self.model = model
+        self.using = using
+        # SQL for parameters not requiring placeholders expansion
+        self.plain_query = raw_query % (('%s',) * len(slots))
+
+    def __repr__(self):
+        return '<%s>(%s)' % (self.__class__.__name__, self.raw_query)
+
+    def render(self, values):
+        """ Returns SQL with parameters for actual arguments values.
+
+        :param values: actual arguments of decorated function
+        """
+        placeholders = []
+        real_params = []
+        expanded = False
+        for kind, value in self.slots:
+            if kind == VALUE:
+                value = value(values)
+            elif kind == FRAGMENT:
+                # %s -> (fragment sql)
+                fragment_sql, fragment_params = value(values)
+                placeholders.append(fragment_sql)
+                real_params.extend(fragment_params)
+                expanded = True
+                continue
+            if isinstance(value, (list, tuple)):
+                # IN(%s) -> IN(%s,%s,%s)
+                placeholders.append(', '.join(['%s'] * len(value)))
+                real_params.extend(value)
+                expanded = True
+            else:
+                placeholders.append('%s')
+                real_params.append(value)
+        if expanded:
+            sql = self.raw_query % tuple(placeholders)
+        else:
+            sql = self.plain_query
+        return sql, tuple(map(datetime_to_str, real_params))
@@ -0,0 +1,96 @@
+# coding: utf-8
+from collections import defaultdict
+from weakref import WeakSet
+
+from typing import Dict, Tuple, Any
+
+from .lazy import Lazy, IntLazy, UnicodeLazy, LazyFragment
+from .queryset import get_slots
+
+
+# query parameters type
+ParamsType = Tuple[Any]
+
+# query parameters slots type
+SlotsType = Tuple[Tuple[int, Any]]
+
+# prepared queries cache for arguments list
+CacheType = Dict[Tuple, Dict[Tuple, Any]]
+
+# Lazy classes without any state except parameter name
+PLAIN_LAZY_CLASSES = (Lazy, IntLazy, UnicodeLazy)
+
+
+def get_layout(param):
+    # type: (Any) -> Tuple
+    """ Returns hashable description of query parameter.
+
+    :raises TypeError: parameter could not be shared between queries.
+    """
+    if type(param) in PLAIN_LAZY_CLASSES:
+        # noinspection PyProtectedMember
+        return type(param), param._Lazy__key
+    if isinstance(param, (Lazy, LazyFragment)):
+        raise TypeError(param)
+    return type(param), param
+
+
+class TemplateRegistry(object):
+    """ Process-wide storage for prepared queries caches.
+
+    Caches are shared by decorators wrapping the same function for the same
+    model; SQL strings and parameters slots are shared by all cached
+    queries.
+    """
+
+    def __init__(self):
+        # prepared queries caches for function, model and decorator options
+        self.caches = {}  # type: Dict[Tuple, CacheType]
+        # unique SQL templates
+        self.sql = {}  # type: Dict[str, str]
+        # query parameters slots for parameters layouts
+        self.slots = {}  # type: Dict[Tuple, SlotsType]
+        # decorators holding references to caches
+        self.decorators = WeakSet()
+
+    def register(self, decorator):
+        """ Registers decorator for resetting its caches references."""
+        self.decorators.add(decorator)
+
+    def get_cache(self, key):
+        # type: (Tuple) -> CacheType
+        """ Returns prepared queries cache for a key."""
+        try:
+            return self.caches[key]
+        except KeyError:
+            return self.caches.setdefault(key, defaultdict(dict))
+
+    def intern_sql(self, sql):
+        # type: (str) -> str
+        """ Returns shared copy of SQL template."""
+        return self.sql.setdefault(sql, sql)
+
+    def get_slots(self, params):
+        # type: (ParamsType) -> SlotsType
+        """ Returns shared query parameters slots if possible."""
+        try:
+            layout = tuple(get_layout(p) for p in params)
+            return self.slots[layout]
+        except TypeError:
+            # unhashable or stateful parameters
+            return get_slots(params)
+        except KeyError:
+            return self.slots.setdefault(layout, get_slots(params))
+
+    def clear(self):
+        """ Drops all prepared queries, including ones referenced by
+        registered decorators."""
+        for decorator in self.decorators:
+            decorator.cache.clear()
+        self.caches.clear()
+        self.sql.clear()
+        self.slots.clear()
+
+
+# process-wide templates registry
+registry = TemplateRegistry()
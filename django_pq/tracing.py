@@ -0,0 +1,107 @@
+# coding: utf-8
+import re
+from collections import defaultdict
+from timeit import default_timer
+
+from typing import Dict, Callable, Optional
+
+from .queryset import RawQuerySet
+
+
+# SQL comment added to cached queries
+TEMPLATE_ID_RE = re.compile(r'^/\* (pq:\S+) \*/ ')
+
+# tracer report callback type: (template_id, stage, elapsed) -> None
+ReportType = Callable[[str, str, float], None]
+
+
+def tag_sql(sql, template_id):
+    # type: (str, str) -> str
+    """ Adds template ID comment to SQL query."""
+    return '/* %s */ %s' % (template_id, sql)
+
+
+def get_template_id(sql):
+    # type: (str) -> Optional[str]
+    """ Returns template ID from SQL query comment."""
+    match = TEMPLATE_ID_RE.match(sql)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+class QueryTracer(object):
+    """ Collects prepared queries timings by template ID.
+
+    Instance is used as connection.execute_wrapper() for measuring execute
+    time; substitute and materialize times are reported by LazySubstitute.
+    """
+
+    def __init__(self, report=None):
+        # type: (Optional[ReportType]) -> None
+        """
+        :param report: callback called with template ID, stage name and
+            elapsed time for each measurement
+        """
+        self.report_callback = report
+        # total time for template ID and stage name
+        self.stats = defaultdict(
+            lambda: defaultdict(float))  # type: Dict[str, Dict[str, float]]
+        # executions count for template ID
+        self.counts = defaultdict(int)  # type: Dict[str, int]
+
+    def report(self, template_id, stage, elapsed):
+        # type: (str, str, float) -> None
+        """ Records stage time for template ID."""
+        self.stats[template_id][stage] += elapsed
+        if self.report_callback is not None:
+            self.report_callback(template_id, stage, elapsed)
+
+    def __call__(self, execute, sql, params, many, context):
+        template_id = get_template_id(sql)
+        if template_id is None:
+            return execute(sql, params, many, context)
+        started = default_timer()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.counts[template_id] += 1
+            self.report(template_id, 'execute', default_timer() - started)
+
+
+class TracedRawQuerySet(RawQuerySet):
+    """ RawQuerySet reporting model instances materialization time."""
+
+    tracer = None  # type: Optional[QueryTracer]
+
+    template_id = None  # type: Optional[str]
+
+    def _clone(self):
+        clone = super(TracedRawQuerySet, self)._clone()
+        clone.tracer = self.tracer
+        clone.template_id = self.template_id
+        return clone
+
+    def trace(self, iterable):
+        """ Reports iteration time excluding query execution time."""
+        if self.tracer is None:
+            for obj in iterable:
+                yield obj
+            return
+        stats = self.tracer.stats[self.template_id]
+        executed = stats['execute']
+        started = default_timer()
+        try:
+            for obj in iterable:
+                yield obj
+        finally:
+            elapsed = default_timer() - started - (stats['execute'] - executed)
+            self.tracer.report(self.template_id, 'materialize', elapsed)
+
+    if hasattr(RawQuerySet, 'iterator'):
+        # Django>=2.1 caches RawQuerySet results
+        def iterator(self):
+            return self.trace(super(TracedRawQuerySet, self).iterator())
+    else:
+        def __iter__(self):
+            return self.trace(super(TracedRawQuerySet, self).__iter__())
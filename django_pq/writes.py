@@ -0,0 +1,293 @@
+# coding: utf-8
+from logging import getLogger
+
+from django.db import connections, models, router, transaction
+from django.db.models import sql
+from django.db.models.expressions import Value
+from typing import Dict, Tuple, Any, List, Optional
+
+from .cache import (LazySubstitute, SqlMappingFailed, ParamsMappingFailed,
+                    SqlWithParams, ParamsType)
+from .lazy import Lazy, reveal
+from .queryset import QueryTemplate
+
+
+# SQL templates cache for bulk inserts
+InsertCacheType = Dict[Tuple[str, int], str]
+
+
+def chain_query(query, klass):
+    """ Returns a copy of query converted to another query class."""
+    if hasattr(query, 'chain'):
+        # Django>=2.0
+        return query.chain(klass)
+    return query.clone(klass)
+
+
+class LazySaveValue(Lazy):
+    """ Lazy value prepared for saving to a field when revealed."""
+
+    def __init__(self, key, field, connection):
+        super(LazySaveValue, self).__init__(key)
+        self.field = field
+        self.connection = connection
+
+    def reveal(self, safe=False):
+        value = super(LazySaveValue, self).reveal(safe=safe)
+        if isinstance(value, Lazy):
+            return value
+        return self.field.get_db_prep_save(value, connection=self.connection)
+
+    def get_extractor(self):
+        get_value = super(LazySaveValue, self).get_extractor()
+        field, connection = self.field, self.connection
+
+        def extract(values):
+            return field.get_db_prep_save(get_value(values),
+                                          connection=connection)
+
+        return extract
+
+
+class PreparedStatement(object):
+    """ Cached write query with parameters."""
+
+    def __init__(self, raw_query, params=None, using=None):
+        self.raw_query = raw_query
+        self.params = params or ()
+        self.using = using
+
+    def __repr__(self):
+        return '<%s>(%s)' % (self.__class__.__name__, self.raw_query)
+
+    def execute(self):
+        # type: () -> int
+        """ Executes write query and returns affected rows count."""
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(self.raw_query, self.params)
+            return cursor.rowcount
+
+
+class WriteQuery(object):
+    """ Write query that is not executed until it's time to.
+
+    Only single table writes could be prepared; delete queries do not
+    collect related objects and do not send signals.
+    """
+
+    def __init__(self, qs, klass):
+        if not qs.query.can_filter():
+            raise TypeError("Cannot update or delete a query once a slice "
+                            "has been taken.")
+        self.query = chain_query(qs.query, klass)
+        self.using = qs._db or router.db_for_write(qs.model, **qs._hints)
+
+    def __repr__(self):
+        return '<%s>(%s)' % (self.__class__.__name__, self.query)
+
+    def sql_with_params(self):
+        # type: () -> SqlWithParams
+        """ Compiles write query to SQL."""
+        query = self.query
+        query.get_initial_alias()
+        tables = [a for a, c in query.alias_refcount.items() if c]
+        if len(tables) > 1 or getattr(query, 'related_updates', None):
+            raise ValueError("Only single table writes could be prepared")
+        return query.get_compiler(self.using).as_sql()
+
+    def execute(self):
+        # type: () -> int
+        """ Executes write query and returns affected rows count."""
+        raw_query, params = self.sql_with_params()
+        return PreparedStatement(raw_query, params, self.using).execute()
+
+
+def update_query(qs, **values):
+    # type: (models.QuerySet, Dict[str, Any]) -> WriteQuery
+    """ Returns not executed QuerySet.update() query."""
+    write_query = WriteQuery(qs, sql.UpdateQuery)
+    connection = connections[write_query.using]
+    for name, value in values.items():
+        if reveal(value) is None:
+            # None is a part of cache key and is rendered as NULL
+            values[name] = None
+        elif isinstance(value, Lazy):
+            # field.get_db_prep_save() reveals Lazy value, so it's postponed
+            # until parameters normalization.
+            field = qs.model._meta.get_field(name)
+            values[name] = Value(LazySaveValue(value, field, connection))
+    write_query.query.add_update_values(values)
+    return write_query
+
+
+def delete_query(qs):
+    # type: (models.QuerySet) -> WriteQuery
+    """ Returns not executed raw delete query for queryset."""
+    return WriteQuery(qs, sql.DeleteQuery)
+
+
+class LazyWriteSubstitute(LazySubstitute):
+    """ Decorator for write queries caching.
+
+    Decorated function must return update_query() or delete_query() result.
+    """
+
+    @staticmethod
+    def get_db(this):
+        # type: (Any) -> Optional[str]
+        model = getattr(this, 'model', None)
+        if model is None:
+            return None
+        return getattr(this, '_db', None) or router.db_for_write(model)
+
+    @staticmethod
+    def get_sql_with_params(qs):
+        # type: (WriteQuery) -> SqlWithParams
+        return qs.sql_with_params()
+
+    @staticmethod
+    def get_prepared_result(raw_query, slots, qs):
+        # type: (str, Tuple, WriteQuery) -> QueryTemplate
+        return QueryTemplate(raw_query, slots, using=qs.using)
+
+    @staticmethod
+    def get_traced_result(qs, tracer, template_id):
+        # type: (PreparedStatement, Any, str) -> PreparedStatement
+        # execute time is reported by tracer as execute_wrapper
+        return qs
+
+    @staticmethod
+    def get_normalized_queryset(qs, values):
+        # type: (QueryTemplate, Dict[str, Any]) -> PreparedStatement
+        """
+        Returns a statement for cached template with SQL query normalized
+        respecting current actual parameters values.
+        """
+        raw_query, params = qs.render(values)
+
+        return PreparedStatement(raw_query, params, qs.using)
+
+
+def get_bucket(count, max_size):
+    # type: (int, int) -> int
+    """ Returns largest power of two not exceeding count and max_size."""
+    bucket = 1
+    while bucket * 2 <= min(count, max_size):
+        bucket *= 2
+    return bucket
+
+
+class PreparedBulkInsert(object):
+    """ QuerySet.bulk_create() replacement with cached SQL templates.
+
+    Templates are cached for power of two rows counts, and batches of same
+    size are passed to executemany. Primary keys are not set for inserted
+    objects and signals are not sent.
+    """
+
+    logger = getLogger('django.db.backends.Substitute')
+
+    def __init__(self, model, fields=None, debug=True):
+        # type: (type, Optional[List[str]], bool) -> None
+        """
+        :param model: model class
+        :param fields: names of inserted fields, local concrete fields except
+            AutoField by default
+        :param debug: enables checking cached SQL against native one
+        """
+        self.model = model
+        opts = model._meta
+        for parent in opts.get_parent_list():
+            if parent._meta.concrete_model is not opts.concrete_model:
+                raise ValueError(
+                    "Can't bulk create a multi-table inherited model")
+        if fields is None:
+            self.fields = [f for f in opts.local_concrete_fields
+                           if not isinstance(f, models.AutoField)]
+        else:
+            self.fields = [opts.get_field(name) for name in fields]
+        self.DEBUG = debug
+        # prepared inserts cache
+        self.cache = {}  # type: InsertCacheType
+
+    def get_params(self, objs, connection):
+        # type: (List[models.Model], Any) -> ParamsType
+        """ Computes query parameters for inserted objects.
+
+        Field values are pre-saved to objects, i.e. auto_now fields are set.
+        """
+        return tuple(f.get_db_prep_save(f.pre_save(obj, True),
+                                        connection=connection)
+                     for obj in objs for f in self.fields)
+
+    def get_native_sql(self, objs, using):
+        # type: (List[models.Model], str) -> SqlWithParams
+        """ Compiles insert query for objects without any caching.
+
+        Objects field values are used as is, so pre_save is not called
+        twice for auto_now fields.
+        """
+        query = sql.InsertQuery(self.model)
+        query.insert_values(self.fields, objs, raw=True)
+        # single statement for rows count bucket
+        (raw_query, params), = query.get_compiler(using=using).as_sql()
+        return raw_query, tuple(params)
+
+    def get_template(self, objs, using):
+        # type: (List[models.Model], str) -> str
+        """ Returns SQL template for inserting len(objs) rows."""
+        cache_key = (using, len(objs))
+        try:
+            return self.cache[cache_key]
+        except KeyError:
+            self.logger.debug("Cache miss for %s:%s" %
+                              (self.model.__name__, cache_key))
+            raw_query, _ = self.get_native_sql(objs, using)
+            self.cache[cache_key] = raw_query
+            return raw_query
+
+    def assert_equivalent(self, raw_query, params, objs, using):
+        # type: (str, ParamsType, List[models.Model], str) -> None
+        """ Checks that cached SQL matches native one."""
+        native_query, native_params = self.get_native_sql(objs, using)
+        if raw_query != native_query:  # pragma: no cover
+            raise SqlMappingFailed(raw_query, native_query)
+        if params != native_params:  # pragma: no cover
+            raise ParamsMappingFailed(raw_query, params, native_params)
+
+    def bulk_create(self, objs, using=None):
+        # type: (List[models.Model], Optional[str]) -> List[models.Model]
+        """ Inserts objects into database."""
+        objs = list(objs)
+        if not objs:
+            return objs
+        using = using or router.db_for_write(self.model)
+        connection = connections[using]
+        if connection.features.has_bulk_insert:
+            max_size = connection.ops.bulk_batch_size(self.fields, objs)
+        else:
+            max_size = 1
+
+        with transaction.atomic(using=using, savepoint=False):
+            with connection.cursor() as cursor:
+                start = 0
+                while start < len(objs):
+                    bucket = get_bucket(len(objs) - start, max_size)
+                    # all full buckets are inserted at once
+                    end = start + (len(objs) - start) // bucket * bucket
+                    raw_query = self.get_template(objs[start:start + bucket],
+                                                  using)
+                    batches = []
+                    for i in range(start, end, bucket):
+                        batch = objs[i:i + bucket]
+                        params = self.get_params(batch, connection)
+                        if self.DEBUG:
+                            self.assert_equivalent(raw_query, params, batch,
+                                                   using)
+                        batches.append(params)
+                    if len(batches) > 1:
+                        cursor.executemany(raw_query, batches)
+                    else:
+                        cursor.execute(raw_query, batches[0])
+                    start = end
+        return objs
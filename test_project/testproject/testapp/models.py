@@ -1,6 +1,27 @@
 from django.db import models
 from django.utils.timezone import now
-from django_pq import reveal, substitute_lazy, LazyContext
+from django_pq import (reveal, substitute_lazy, substitute_lazy_write,
+                       prepared_fragment, update_query, delete_query,
+                       LazyContext)
+
+
+@prepared_fragment
+def int_field_fragment(integer=None):
+    if reveal(integer) is None:
+        return models.Q(int_field__gt=0)
+    return models.Q(int_field=integer)
+
+
+@prepared_fragment
+def int_list_fragment(integers=None):
+    if reveal(integers) is None:
+        return models.Q()
+    return models.Q(int_field__in=integers)
+
+
+@prepared_fragment
+def app_label_fragment(app_label=None):
+    return models.Q(content_type__app_label=app_label)
 
 
 class TestManager(models.Manager):
@@ -18,6 +39,31 @@ class TestManager(models.Manager):
 
     filter_test_model = ftm_decorator(_filter_test_model)
 
+    ftf_decorator = substitute_lazy(fragments=['integer'])
+
+    def _filter_fragments(self, integer=None, dt=None):
+        qs = int_field_fragment.filter(TestModel.objects.all(),
+                                       integer=integer)
+        if reveal(dt):
+            qs = qs.filter(dt_field__lte=dt)
+        return qs
+
+    filter_fragments = ftf_decorator(_filter_fragments)
+
+    # one decorator for several functions
+    write_decorator = substitute_lazy_write()
+
+    def _update_test_model(self, integers=None, value=None):
+        qs = TestModel.objects.filter(int_field__in=integers)
+        return update_query(qs, int_field=value)
+
+    update_test_model = write_decorator(_update_test_model)
+
+    def _delete_test_model(self, integers=None):
+        return delete_query(TestModel.objects.filter(int_field__in=integers))
+
+    delete_test_model = write_decorator(_delete_test_model)
+
 
 class TestModel(models.Model):
     objects = TestManager()
@@ -26,6 +72,23 @@ class TestModel(models.Model):
     dt_field = models.DateTimeField(default=now)
 
 
+class TimestampedManager(models.Manager):
+
+    wtm_decorator = substitute_lazy_write()
+
+    def _update_timestamped_model(self, value=None):
+        return update_query(TimestampedModel.objects.all(), value=value)
+
+    update_timestamped_model = wtm_decorator(_update_timestamped_model)
+
+
+class TimestampedModel(models.Model):
+    objects = TimestampedManager()
+
+    value = models.IntegerField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+
 def list_to_none(kwargs):
     integers = kwargs.get('integers')
     if isinstance(integers, (list, tuple)) and not integers:
@@ -36,4 +99,26 @@ def list_to_none(kwargs):
 def run_cached(**kwargs):
     with LazyContext(list_to_none, **kwargs) as lazy_kwargs:
         qs = TestModel.objects.filter_test_model(**lazy_kwargs)
-        return qs[0]
\ No newline at end of file
+        return qs[0]
+
+
+def run_fragments(**kwargs):
+    with LazyContext(**kwargs) as lazy_kwargs:
+        qs = TestModel.objects.filter_fragments(**lazy_kwargs)
+        return list(qs)
+
+
+def run_update(**kwargs):
+    with LazyContext(**kwargs) as lazy_kwargs:
+        return TestModel.objects.update_test_model(**lazy_kwargs).execute()
+
+
+def run_delete(**kwargs):
+    with LazyContext(**kwargs) as lazy_kwargs:
+        return TestModel.objects.delete_test_model(**lazy_kwargs).execute()
+
+
+def run_update_timestamped(**kwargs):
+    with LazyContext(**kwargs) as lazy_kwargs:
+        qs = TimestampedModel.objects.update_timestamped_model(**lazy_kwargs)
+        return qs.execute()
@@ -1,18 +1,37 @@
+from unittest import skipUnless
+
 import mock
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
 from django.test import TestCase
 
-from testproject.testapp.models import TestModel, run_cached
+from django_pq import (PreparedBulkInsert, AdaptivePolicy, QueryTracer,
+                       LazyContext, registry, substitute_lazy, update_query,
+                       delete_query)
+from django_pq.lazy import Lazy, LazyFragment
+from testproject.testapp.models import (TestModel, TestManager, run_cached,
+                                        run_fragments, run_update, run_delete,
+                                        int_field_fragment, int_list_fragment,
+                                        app_label_fragment, TimestampedModel,
+                                        run_update_timestamped)
 
 
 # noinspection PyUnusedLocal
 class CacheTestCase(TestCase):
+    multi_db = True
+
     def setUp(self):
         self.t1 = TestModel.objects.create(int_field=1)
         self.t2 = TestModel.objects.create(int_field=2)
 
     def tearDown(self):
         super(CacheTestCase, self).tearDown()
-        TestModel.objects.ftm_decorator.cache.clear()
+        int_field_fragment.cache.clear()
+        int_list_fragment.cache.clear()
+        app_label_fragment.cache.clear()
+        # decorators caches are cleared too
+        registry.clear()
 
     def test_run_cached(self):
         x = run_cached(integers=[1])
@@ -41,3 +60,265 @@ class CacheTestCase(TestCase):
         x = run_cached(integers=[1])
         self.assertEqual(x, self.t1)
         self.assertEqual(len(TestModel.objects.ftm_decorator.cache), 1)
+
+    def test_run_fragments(self):
+        x = run_fragments(integer=2)
+        self.assertEqual(x, [self.t2])
+        x = run_fragments(integer=None)
+        self.assertEqual(x, [self.t1, self.t2])
+        # fragment argument values do not multiply queryset templates
+        self.assertEqual(len(TestModel.objects.ftf_decorator.cache), 1)
+        self.assertEqual(len(int_field_fragment.cache), 2)
+        # check cache hit
+        x = run_fragments(integer=3)
+        self.assertEqual(x, [])
+        self.assertEqual(len(int_field_fragment.cache), 2)
+        # fragment parameters slots are not shared between queries
+        for layout in registry.slots:
+            self.assertNotIn(LazyFragment, [t for t, _ in layout])
+
+    def test_fragment_without_cache(self):
+        qs = int_field_fragment.filter(TestModel.objects.all(), integer=2)
+        self.assertEqual(list(qs), [self.t2])
+
+    def test_fragment_in_subquery(self):
+        subquery = int_field_fragment.filter(TestModel.objects.all(),
+                                             integer=2).values('pk')
+        qs = TestModel.objects.filter(pk__in=subquery)
+        self.assertIn('U0."int_field" = ', str(qs.query))
+        self.assertEqual(list(qs), [self.t2])
+
+    def test_fragment_with_join(self):
+        expected = list(Permission.objects.filter(
+            content_type__app_label='testapp').order_by('pk'))
+        self.assertTrue(expected)
+        qs = app_label_fragment.filter(Permission.objects.order_by('pk'),
+                                       app_label='testapp')
+        self.assertIn(' IN (SELECT ', str(qs.query))
+        self.assertEqual(list(qs), expected)
+        decorator = substitute_lazy(fragments=['app_label'])
+        filter_permissions = decorator(filter_app_permissions)
+        for app_label in ('auth', 'testapp'):
+            with LazyContext(app_label=app_label) as lazy_kwargs:
+                qs = filter_permissions(Permission.objects, **lazy_kwargs)
+                self.assertEqual(list(qs), list(Permission.objects.filter(
+                    content_type__app_label=app_label).order_by('pk')))
+        self.assertEqual(list(qs), expected)
+        self.assertEqual(len(app_label_fragment.cache), 1)
+
+    def test_fragment_empty_match(self):
+        qs = int_list_fragment.filter(TestModel.objects.all(), integers=[])
+        self.assertIn('1 = 0', str(qs.query))
+        self.assertEqual(list(qs), [])
+
+    def test_fragment_full_match(self):
+        qs = int_list_fragment.filter(TestModel.objects.order_by('pk'),
+                                      integers=None)
+        self.assertIn('1 = 1', str(qs.query))
+        self.assertEqual(list(qs), [self.t1, self.t2])
+
+    def test_run_update(self):
+        self.assertEqual(run_update(integers=[1, 2], value=3), 2)
+        # check cache hit
+        self.assertEqual(run_update(integers=[3], value=4), 2)
+        self.assertEqual(len(TestModel.objects.write_decorator.cache), 1)
+        self.assertEqual(TestModel.objects.filter(int_field=4).count(), 2)
+
+    def test_run_delete(self):
+        self.assertEqual(run_delete(integers=[2]), 1)
+        # check cache hit
+        self.assertEqual(run_delete(integers=[3]), 0)
+        self.assertEqual(list(TestModel.objects.all()), [self.t1])
+        # decorator is shared with update function
+        self.assertEqual(run_update(integers=[1], value=3), 1)
+        self.assertEqual(len(TestModel.objects.write_decorator.cache), 2)
+
+    def test_update_nullable_field(self):
+        TimestampedModel.objects.create(value=1)
+        self.assertEqual(run_update_timestamped(value=None), 1)
+        self.assertEqual(run_update_timestamped(value=2), 1)
+        # None is a part of cache key
+        cache, = TimestampedModel.objects.wtm_decorator.cache.values()
+        self.assertEqual(len(cache[('value',)]), 2)
+        self.assertEqual(run_update_timestamped(value=None), 1)
+        self.assertIsNone(TimestampedModel.objects.get().value)
+
+    def test_sliced_write_query(self):
+        qs = TestModel.objects.order_by('pk')[:1]
+        with self.assertRaises(TypeError):
+            update_query(qs, int_field=7)
+        with self.assertRaises(TypeError):
+            delete_query(qs)
+
+    def test_bulk_insert(self):
+        bulk_insert = PreparedBulkInsert(TestModel)
+        bulk_insert.bulk_create(TestModel(int_field=3) for _ in range(7))
+        self.assertEqual(sorted(bulk_insert.cache),
+                         [('default', 1), ('default', 2), ('default', 4)])
+        with mock.patch.object(connection.ops, 'bulk_batch_size',
+                               return_value=2):
+            bulk_insert.bulk_create(TestModel(int_field=4) for _ in range(5))
+        self.assertEqual(len(bulk_insert.cache), 3)
+        self.assertEqual(TestModel.objects.filter(int_field=3).count(), 7)
+        self.assertEqual(TestModel.objects.filter(int_field=4).count(), 5)
+
+    def test_bulk_insert_auto_now_add(self):
+        bulk_insert = PreparedBulkInsert(TimestampedModel)
+        objs = bulk_insert.bulk_create(TimestampedModel(value=1)
+                                       for _ in range(3))
+        self.assertTrue(all(obj.created is not None for obj in objs))
+        self.assertEqual(
+            sorted(TimestampedModel.objects.values_list('created', flat=True)),
+            sorted(obj.created for obj in objs))
+
+    def test_adaptive_policy(self):
+        policy = AdaptivePolicy(window=2, bypass=2)
+        func = TestManager._filter_test_model
+        signature = ('integers',)
+        # cache miss and hit are slower than native call
+        policy.record(func, signature, 1.0, compile_time=0.1)
+        policy.record(func, signature, 1.0)
+        self.assertFalse(policy.is_enabled(func, signature))
+        self.assertFalse(policy.is_enabled(func, signature))
+        # other functions are not affected
+        self.assertTrue(policy.is_enabled(TestManager._delete_test_model,
+                                          signature))
+        # caching is re-probed
+        self.assertTrue(policy.is_enabled(func, signature))
+        # cache hit is faster than native call
+        policy.record(func, signature, 1.0, compile_time=1.9)
+        policy.record(func, signature, 0.1)
+        self.assertTrue(policy.is_enabled(func, signature))
+
+    def test_adaptive_policy_reprobe_hits(self):
+        policy = AdaptivePolicy(window=2, bypass=1)
+        func = TestManager._filter_test_model
+        signature = ('integers',)
+        policy.record(func, signature, 1.0, compile_time=0.1)
+        policy.record(func, signature, 1.0)
+        self.assertFalse(policy.is_enabled(func, signature))
+        # re-probe with warm cache is compared with known compile time
+        policy.record(func, signature, 1.0)
+        policy.record(func, signature, 1.0)
+        self.assertFalse(policy.is_enabled(func, signature))
+        policy.record(func, signature, 0.01)
+        policy.record(func, signature, 0.01)
+        self.assertTrue(policy.is_enabled(func, signature))
+
+    def test_run_bypassed(self):
+        policy = AdaptivePolicy()
+        func = TestManager._filter_test_model
+        policy.bypassed[func, ('integers',)] = 1
+        with mock.patch.object(TestModel.objects.ftm_decorator, 'policy',
+                               policy):
+            x = run_cached(integers=[1])
+            self.assertEqual(x, self.t1)
+            self.assertEqual(len(TestModel.objects.ftm_decorator.cache), 0)
+            # caching is re-probed
+            x = run_cached(integers=[1])
+            self.assertEqual(x, self.t1)
+            self.assertEqual(len(TestModel.objects.ftm_decorator.cache), 1)
+
+    def test_run_traced(self):
+        tracer = QueryTracer()
+        decorator = TestModel.objects.ftm_decorator
+        with mock.patch.object(decorator, 'tracer', tracer), \
+                mock.patch.object(decorator, 'tag', True):
+            x = run_cached(integers=[1])
+            self.assertEqual(x, self.t1)
+            # check cache hit
+            x = run_cached(integers=[1])
+            self.assertEqual(x, self.t1)
+        cache, = decorator.cache.values()
+        (cache_key, cached_qs), = cache[('integers',)].items()
+        self.assertTrue(cached_qs.raw_query.startswith('/* pq:'))
+        template_id, = tracer.stats
+        self.assertTrue(template_id.startswith(
+            'pq:TestManager._filter_test_model:'))
+        # same manager method for another model has distinct template ID
+        other_id = decorator.get_template_id(
+            TestManager._filter_test_model, ContentType, ('integers',),
+            cache_key)
+        self.assertNotEqual(other_id, template_id)
+        self.assertIn('substitute', tracer.stats[template_id])
+        self.assertIn('materialize', tracer.stats[template_id])
+
+    @skipUnless(hasattr(connection, 'execute_wrapper'),
+                'connection.execute_wrapper requires Django>=2.0')
+    def test_run_traced_execute(self):
+        tracer = QueryTracer()
+        decorator = TestModel.objects.ftm_decorator
+        with mock.patch.object(decorator, 'tracer', tracer), \
+                mock.patch.object(decorator, 'tag', True), \
+                connection.execute_wrapper(tracer):
+            x = run_cached(integers=[1])
+            self.assertEqual(x, self.t1)
+            # check cache hit
+            x = run_cached(integers=[1])
+            self.assertEqual(x, self.t1)
+        template_id, = tracer.stats
+        self.assertEqual(tracer.counts[template_id], 2)
+        self.assertEqual(sorted(tracer.stats[template_id]),
+                         ['execute', 'materialize', 'substitute'])
+
+    def test_run_using(self):
+        t3 = TestModel.objects.using('other').create(int_field=3)
+        decorator = substitute_lazy()
+        filter_other = decorator(filter_other_db)
+        for integers in ([3], [1, 3]):
+            with LazyContext(integers=integers) as lazy_kwargs:
+                qs = filter_other(TestModel.objects, **lazy_kwargs)
+                self.assertEqual(qs.db, 'other')
+                self.assertEqual(list(qs), [t3])
+        # prepared queries are cached for "self" database
+        with LazyContext(integers=[3]) as lazy_kwargs:
+            qs = filter_other(TestModel.objects.db_manager('other'),
+                              **lazy_kwargs)
+            self.assertEqual(list(qs), [t3])
+        self.assertEqual(sorted(using for _, _, using in decorator.cache),
+                         ['default', 'other'])
+
+    def test_shared_templates(self):
+        x = run_cached(integers=[1])
+        self.assertEqual(x, self.t1)
+        decorator = substitute_lazy()
+        filter_test_model = decorator(TestManager._filter_test_model)
+        with LazyContext(integers=[1]) as lazy_kwargs:
+            qs = filter_test_model(TestModel.objects, **lazy_kwargs)
+            self.assertEqual(qs[0], self.t1)
+        cache, = decorator.cache.values()
+        self.assertIs(cache,
+                      list(TestModel.objects.ftm_decorator.cache.values())[0])
+        template, = cache[('integers',)].values()
+        self.assertIs(registry.sql.get(template.plain_query),
+                      template.plain_query)
+        # decorators are still sharing caches after clear
+        registry.clear()
+        self.assertEqual(TestModel.objects.ftm_decorator.cache, {})
+        x = run_cached(integers=[1])
+        self.assertEqual(x, self.t1)
+        with LazyContext(integers=[1]) as lazy_kwargs:
+            filter_test_model(TestModel.objects, **lazy_kwargs)
+        cache, = decorator.cache.values()
+        self.assertIs(cache,
+                      list(TestModel.objects.ftm_decorator.cache.values())[0])
+
+    def test_template_without_lazy(self):
+        run_cached(integers=[1])
+        cache, = TestModel.objects.ftm_decorator.cache.values()
+        template, = cache[('integers',)].values()
+        for kind, value in template.slots:
+            self.assertNotIsInstance(value, Lazy)
+        with LazyContext(integers=[1, 2]) as lazy_kwargs:
+            qs = TestModel.objects.filter_test_model(**lazy_kwargs)
+        self.assertEqual(qs.params, (1, 2))
+        self.assertEqual(list(qs), [self.t1, self.t2])
+
+
+def filter_other_db(this, integers=None):
+    return TestModel.objects.using('other').filter(int_field__in=integers)
+
+
+def filter_app_permissions(this, app_label=None):
+    return app_label_fragment.filter(Permission.objects.order_by('pk'),
+                                     app_label=app_label)